@@ -2,10 +2,23 @@
 import os
 import json
 import uuid
-import requests
-import traceback
-from typing import List
-from flask import Flask, request, jsonify, session
+import asyncio
+import hashlib
+import httpx
+import atexit
+import logging
+import logging.handlers
+import queue
+import weakref
+from collections import defaultdict
+from typing import List, Optional
+import cachetools
+import orjson
+import msgpack
+import redis.asyncio as redis
+from redis.exceptions import WatchError
+from quart import Quart, request, jsonify, session
+from quart.json.provider import DefaultJSONProvider
 # Gemini client imports (tal como en tu archivo original)
 from google import genai
 from google.genai import types
@@ -19,22 +32,144 @@ PROJECT_ID = os.environ.get("GEMINI_PROJECT_ID", "tu-id-de-proyecto-aqui")
 # Aquí esperamos solo el ID del store final (sin prefijo). Ajusta si tu valor actual ya tiene prefijo.
 FILE_SEARCH_STORE_ID = os.environ.get("FILE_SEARCH_STORE_ID", "hotelknowledgebasestore2-g76jm0ml54f0")
 FULL_STORE_NAME = f"projects/{PROJECT_ID}/locations/global/fileSearchStores/{FILE_SEARCH_STORE_ID}"
+FILE_SEARCH_STORE_NAME = "fileSearchStores/" + FILE_SEARCH_STORE_ID
 
 # WhatsApp / Facebook config
 WHATSAPP_TOKEN = os.environ.get("WHATSAPP_TOKEN", "")
 WHATSAPP_VERIFY_TOKEN = os.environ.get("WHATSAPP_VERIFY_TOKEN", "verify123")
 WHATSAPP_PHONE_ID = os.environ.get("WHATSAPP_PHONE_ID", "")
-
-# Flask session secret (solo para desarrollo; en producción pon un valor seguro en ENV)
+# Reintentos ante errores transitorios de la Graph API (backoff exponencial desde 0.2 s).
+# El POST a /messages no es idempotente: un 5xx puede llegar con el mensaje ya aceptado, así que
+# solo se reintenta con 429 (rechazado por límite) o 503 con Retry-After. Los fallos de conexión
+# los reintenta el transporte HTTP.
+WHATSAPP_MAX_RETRIES = int(os.environ.get("WHATSAPP_MAX_RETRIES", 3))
+
+# Redis para el historial de conversaciones (compartido entre workers y reinicios).
+# Si REDIS_URL no está definido se usa el store en memoria de cada worker.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+HISTORY_TTL_SECONDS = int(os.environ.get("HISTORY_TTL_SECONDS", 24 * 3600))
+# Turnos (pregunta + respuesta) que se envían a Gemini. Los más antiguos se condensan en un
+# resumen para no pagar tokens proporcionales a toda la conversación.
+HISTORY_MAX_TURNS = int(os.environ.get("HISTORY_MAX_TURNS", 10))
+HISTORY_MAX_ENTRIES = HISTORY_MAX_TURNS * 2  # mensajes (user + model)
+# El resumen se actualiza cada HISTORY_SUMMARY_BATCH_TURNS turnos en una sola llamada (no una por
+# mensaje), así que Gemini recibe como mucho HISTORY_MAX_TURNS + HISTORY_SUMMARY_BATCH_TURNS turnos.
+# El límite duro solo actúa si el resumen falla.
+HISTORY_SUMMARY_BATCH_TURNS = int(os.environ.get("HISTORY_SUMMARY_BATCH_TURNS", 4))
+HISTORY_SUMMARY_TRIGGER = HISTORY_MAX_ENTRIES + HISTORY_SUMMARY_BATCH_TURNS * 2
+HISTORY_HARD_MAX_ENTRIES = HISTORY_SUMMARY_TRIGGER * 2
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+
+# Ventana durante la cual un message_id ya recibido se considera reintento de Meta
+DEDUP_TTL_SECONDS = int(os.environ.get("DEDUP_TTL_SECONDS", 300))
+
+# Llamada mínima a Gemini al arrancar cada worker para abrir la conexión antes del primer mensaje
+GEMINI_WARMUP = os.environ.get("GEMINI_WARMUP", "1") == "1"
+
+# Caché de respuestas para preguntas sin contexto previo (FAQs repetidas)
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 3600))
+
+# Session secret de Quart (solo para desarrollo; en producción pon un valor seguro en ENV)
+# Se mantiene el nombre FLASK_SECRET_KEY por compatibilidad con despliegues existentes.
 FLASK_SECRET_KEY = os.environ.get("FLASK_SECRET_KEY", "cambia_esto_por_una_clave_segura")
 
 # -------------------------
 # INICIALIZACIÓN
 # -------------------------
-client = genai.Client(api_key=API_KEY)
+def _configurar_logging() -> None:
+    """
+    Los handlers del logger raíz solo encolan el registro; un hilo (QueueListener) hace la
+    escritura bloqueante a stdout, fuera del ciclo de las peticiones.
+    """
+    log_queue = queue.Queue(-1)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+    listener.start()
+    atexit.register(listener.stop)
+
+_configurar_logging()
+logger = logging.getLogger("webhook")
+
+# El cliente de Gemini se crea de forma perezosa: gunicorn hace fork de varios workers
+# y cada uno debe abrir sus propias conexiones en lugar de heredar las del proceso maestro.
+_client = None
+
+def get_client() -> genai.Client:
+    """
+    Devuelve el cliente de Gemini del worker actual, creándolo en el primer uso.
+    """
+    global _client
+    if _client is None:
+        _client = genai.Client(api_key=API_KEY)
+    return _client
+
+# Cliente HTTP compartido para la Graph API de WhatsApp: HTTP/2 multiplexa los envíos
+# concurrentes sobre una misma conexión keep-alive en lugar de pagar TCP + TLS en cada mensaje.
+_wa_session = None
+
+def get_wa_session() -> httpx.AsyncClient:
+    """
+    Devuelve el cliente HTTP de WhatsApp del worker actual, creándolo en el primer uso.
+    """
+    global _wa_session
+    if _wa_session is None or _wa_session.is_closed:
+        _wa_session = httpx.AsyncClient(
+            timeout=10.0,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+                # Reintenta solo fallos al conectar (el mensaje no llegó a enviarse)
+                retries=WHATSAPP_MAX_RETRIES
+            )
+        )
+    return _wa_session
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Proveedor JSON de Quart basado en orjson: lo usan request.get_json() y jsonify().
+    """
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
-app = Flask(__name__)
+app = Quart(__name__)
 app.secret_key = FLASK_SECRET_KEY
+app.json = OrjsonProvider(app)
+
+@app.before_serving
+async def calentar_cliente_gemini():
+    """
+    Hace una petición trivial a Gemini para que DNS, TLS y el pool de conexiones del cliente
+    estén listos antes del primer mensaje real. Un fallo aquí no impide arrancar.
+    """
+    if not GEMINI_WARMUP:
+        return
+    try:
+        await asyncio.wait_for(
+            get_client().aio.models.generate_content(
+                model="gemini-2.5-flash",
+                contents=[types.Content(role="user", parts=[types.Part(text="ping")])],
+                config=types.GenerateContentConfig(max_output_tokens=1)
+            ),
+            timeout=10
+        )
+    except Exception as e:
+        logger.warning("No se pudo precalentar el cliente de Gemini: %s", e)
+
+@app.after_serving
+async def cerrar_sesiones_http():
+    if _wa_session is not None:
+        await _wa_session.aclose()
+    if redis_client is not None:
+        await redis_client.aclose()
 
 # -------------------------
 # INSTRUCCIÓN DEL SISTEMA (tu prompt del agente)
@@ -48,91 +183,360 @@ SYSTEM_PROMPT_RESERVAS = (
     "Siempre mantén un tono de servicio al cliente y anima al usuario a hacer una reserva o continuar su consulta."
 )
 
+# Respuesta fija para mensajes que no son de texto (imágenes, audios, ubicaciones...)
+MENSAJE_NO_SOPORTADO = (
+    "Por ahora solo puedo responder mensajes de texto. "
+    "Escríbeme tu consulta y con gusto te ayudo con tu reserva."
+)
+
+# Configuración de generación (prompt + herramienta FileSearch): es constante por despliegue,
+# así que se construye una sola vez al importar el módulo.
+_CACHED_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_PROMPT_RESERVAS,
+    tools=[
+        types.Tool(
+            file_search=types.FileSearch(
+                file_search_store_names=[FILE_SEARCH_STORE_NAME]
+            )
+        )
+    ]
+)
+
 # -------------------------
 # Almacenamiento de historial por remitente
 # -------------------------
-# Nota: esto es un store en memoria (dict). Funciona para pruebas y despliegues simples.
-# Para producción usa Redis, Memcached o una base de datos persistente.
-conversations = {}  # key: whatsapp_number (str) -> value: list of dicts {'role':..., 'text':...}
+# Con REDIS_URL cada remitente tiene una lista 'chat:{sender_id}' con entradas msgpack
+# {'role':..., 'text':...} y con expiración HISTORY_TTL_SECONDS. Al superar HISTORY_SUMMARY_TRIGGER
+# entradas, las más antiguas se resumen en 'chat:{sender_id}:summary' y se quitan de la lista.
+# El cliente trabaja con bytes: el historial se guarda en msgpack y los textos se decodifican al leer.
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+# Nota: sin Redis se usa un store en memoria. Funciona para pruebas y despliegues simples,
+# pero cada worker de gunicorn tiene su propia copia y se pierde al reiniciar.
+# Es un TTLCache (misma API que dict): como mucho 10.000 remitentes y cada conversación expira
+# a las HISTORY_TTL_SECONDS, igual que en Redis, para que la memoria del worker no crezca sin límite.
+conversations = cachetools.TTLCache(maxsize=10_000, ttl=HISTORY_TTL_SECONDS)  # key: whatsapp_number (str) -> value: list of dicts {'role':..., 'text':...}
+summaries = cachetools.TTLCache(maxsize=10_000, ttl=HISTORY_TTL_SECONDS)  # key: whatsapp_number (str) -> value: resumen (str) de los turnos antiguos
+
+# Un lock por remitente para que en cada worker haya como mucho una actualización de resumen en curso
+_summary_locks = weakref.WeakValueDictionary()
+
+SUMMARY_PROMPT = (
+    "Resume en pocas frases la siguiente conversación entre un cliente y el agente de reservas del hotel. "
+    "Conserva los datos útiles para continuarla (fechas, número de personas, tipo de habitación, preferencias, "
+    "preguntas pendientes). Responde solo con el resumen."
+)
+_SUMMARY_CONFIG = types.GenerateContentConfig(system_instruction=SUMMARY_PROMPT)
+
+def _history_key(sender_id: str) -> str:
+    return f"chat:{sender_id}"
+
+def _summary_key(sender_id: str) -> str:
+    return f"chat:{sender_id}:summary"
+
+def _pack_entry(entry: dict) -> bytes:
+    return msgpack.packb(entry, use_bin_type=True)
+
+def _unpack_entry(raw: bytes) -> dict:
+    try:
+        return msgpack.unpackb(raw, raw=False)
+    except ValueError:
+        # Entradas guardadas en JSON antes de pasar a msgpack (expiran con el TTL)
+        return json.loads(raw)
+
+async def cargar_historial(sender_id: str) -> List[dict]:
+    """
+    Devuelve el historial del remitente como lista de dicts {'role':..., 'text':...}.
+    """
+    if redis_client is None:
+        return conversations.get(sender_id, [])
+    raw_entries = await redis_client.lrange(_history_key(sender_id), 0, -1)
+    return [_unpack_entry(raw) for raw in raw_entries]
+
+async def cargar_resumen(sender_id: str) -> str:
+    """
+    Devuelve el resumen de los turnos que ya salieron de la ventana ("" si no hay).
+    """
+    if redis_client is None:
+        return summaries.get(sender_id, "")
+    raw = await redis_client.get(_summary_key(sender_id))
+    return raw.decode() if raw else ""
+
+def _summary_lock(sender_id: str) -> asyncio.Lock:
+    lock = _summary_locks.get(sender_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _summary_locks[sender_id] = lock
+    return lock
+
+async def _resumir(previous: str, older: List[dict]) -> str:
+    lines = [f"{entry['role']}: {entry['text']}" for entry in older]
+    if previous:
+        lines.insert(0, f"Resumen previo: {previous}")
+    response = await get_client().aio.models.generate_content(
+        model="gemini-2.5-flash",
+        contents="\n".join(lines),
+        config=_SUMMARY_CONFIG
+    )
+    return (response.text or "").strip()
+
+async def actualizar_resumen(sender_id: str) -> None:
+    """
+    Si el historial supera HISTORY_SUMMARY_TRIGGER entradas, integra en el resumen las más antiguas
+    y las quita de la lista, dejando las últimas HISTORY_MAX_ENTRIES. Se ejecuta en segundo plano.
+    Las entradas solo se quitan si la lista sigue empezando por ellas: así no se pisa un
+    borrar_historial ni otra actualización concurrente (que ya las habría resumido).
+    """
+    lock = _summary_lock(sender_id)
+    if lock.locked():
+        # Ya hay una en curso; el próximo turno volverá a comprobar la longitud
+        return
+    async with lock:
+        try:
+            if redis_client is None:
+                history = conversations.get(sender_id, [])
+            else:
+                raw_history = await redis_client.lrange(_history_key(sender_id), 0, -1)
+                history = [_unpack_entry(raw) for raw in raw_history]
+            if len(history) <= HISTORY_SUMMARY_TRIGGER:
+                return
+
+            n_older = len(history) - HISTORY_MAX_ENTRIES
+            older = history[:n_older]
+            summary = await _resumir(await cargar_resumen(sender_id), older)
+            if not summary:
+                return
+
+            if redis_client is None:
+                current = conversations.get(sender_id, [])
+                if current[:n_older] != older:
+                    return
+                summaries[sender_id] = summary
+                conversations[sender_id] = current[n_older:]
+                return
+
+            key = _history_key(sender_id)
+            async with redis_client.pipeline(transaction=True) as pipe:
+                await pipe.watch(key)
+                if await pipe.lrange(key, 0, n_older - 1) != raw_history[:n_older]:
+                    return
+                pipe.multi()
+                pipe.set(_summary_key(sender_id), summary, ex=HISTORY_TTL_SECONDS)
+                pipe.ltrim(key, n_older, -1)
+                await pipe.execute()
+        except WatchError:
+            # La lista cambió por delante (borrado u otra actualización): se descarta este resumen
+            pass
+        except Exception:
+            logger.exception("Error actualizando el resumen de la conversación")
+
+async def guardar_turno(sender_id: str, user_text: str, respuesta: str) -> None:
+    """
+    Añade la pregunta del usuario y la respuesta del modelo al historial del remitente.
+    """
+    entries = [
+        {'role': 'user', 'text': user_text},
+        {'role': 'model', 'text': respuesta}
+    ]
+    if redis_client is None:
+        history = (conversations.get(sender_id, []) + entries)[-HISTORY_HARD_MAX_ENTRIES:]
+        conversations[sender_id] = history
+        # Reasignar renueva el TTL del resumen, igual que el EXPIRE en Redis
+        if sender_id in summaries:
+            summaries[sender_id] = summaries[sender_id]
+        length = len(history)
+    else:
+        key = _history_key(sender_id)
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(key, *[_pack_entry(entry) for entry in entries])
+            pipe.ltrim(key, -HISTORY_HARD_MAX_ENTRIES, -1)
+            pipe.expire(key, HISTORY_TTL_SECONDS)
+            pipe.expire(_summary_key(sender_id), HISTORY_TTL_SECONDS)
+            length, _, _, _ = await pipe.execute()
+        length = min(length, HISTORY_HARD_MAX_ENTRIES)
+
+    if length > HISTORY_SUMMARY_TRIGGER:
+        app.add_background_task(actualizar_resumen, sender_id)
+
+async def borrar_historial(sender_id: str) -> None:
+    """
+    Elimina el historial del remitente.
+    """
+    if redis_client is None:
+        conversations.pop(sender_id, None)
+        summaries.pop(sender_id, None)
+        return
+    await redis_client.delete(_history_key(sender_id), _summary_key(sender_id))
+
+# -------------------------
+# Caché de respuestas de Gemini
+# -------------------------
+# Solo se usa cuando el remitente no tiene historial ni resumen: en ese caso la respuesta
+# depende únicamente del prompt del sistema y de la pregunta, y puede reutilizarse entre usuarios.
+# Con Redis se guarda en 'cache:resp:{hash}'; sin Redis, en un TTLCache en memoria del worker.
+response_cache = cachetools.TTLCache(maxsize=2048, ttl=RESPONSE_CACHE_TTL_SECONDS)
+
+def _response_cache_key(user_text: str) -> str:
+    normalized = " ".join(user_text.split()).casefold()
+    payload = json.dumps([SYSTEM_PROMPT_RESERVAS, normalized], ensure_ascii=False).encode()
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+async def obtener_respuesta_cacheada(cache_key: str) -> Optional[str]:
+    if redis_client is None:
+        return response_cache.get(cache_key)
+    raw = await redis_client.get(f"cache:resp:{cache_key}")
+    return raw.decode() if raw else None
+
+async def guardar_respuesta_cacheada(cache_key: str, respuesta: str) -> None:
+    if redis_client is None:
+        response_cache[cache_key] = respuesta
+        return
+    await redis_client.set(f"cache:resp:{cache_key}", respuesta, ex=RESPONSE_CACHE_TTL_SECONDS)
 
 # -------------------------
 # FUNCIONES AUXILIARES (RAG / FileSearch)
 # -------------------------
-def search_file_store(
+# Memo de mensajes ya convertidos a types.Content, indexado por (role, text). Cada turno del
+# historial se reenvía en muchas llamadas seguidas; así solo se construye una vez por worker,
+# aunque la ventana se desplace o el historial venga de Redis.
+_contents_cache = cachetools.LRUCache(maxsize=10_000)
+
+def content_for(role: str, text: str) -> types.Content:
+    """
+    Devuelve el types.Content de un mensaje, construyéndolo solo si no está en el memo.
+    Los objetos devueltos se comparten: no deben modificarse.
+    """
+    content = _contents_cache.get((role, text))
+    if content is None:
+        content = types.Content(role=role, parts=[types.Part(text=text)])
+        _contents_cache[(role, text)] = content
+    return content
+
+def history_to_contents(history_json: List[dict], user_text: Optional[str] = None) -> List[types.Content]:
+    """
+    Convierte el historial [{'role':..., 'text':...}] (y la nueva pregunta 'user_text', si se
+    indica) en objetos types.Content, reutilizando los ya construidos.
+    """
+    full_contents = [content_for(message['role'], message['text']) for message in history_json]
+    if user_text is not None:
+        # La pregunta entra en el memo: en el siguiente turno se reutiliza el mismo objeto
+        full_contents.append(content_for("user", user_text))
+    return full_contents
+
+async def search_file_store(
     contents: List[types.Content],
-    store_names: List[str],
     model: str = 'gemini-2.5-flash',
-    system_instruction: str = None
+    config: Optional[types.GenerateContentConfig] = None
 ) -> str:
     """
     Realiza una búsqueda usando el historial completo de la conversación (contents) y FileSearch.
+    Por defecto usa '_CACHED_CONFIG' (prompt del agente + store de FileSearch del despliegue).
+    La respuesta se recibe en streaming y se devuelve el texto completo.
     """
-    file_search_config = types.FileSearch(
-        file_search_store_names=store_names
-    )
-
-    response = client.models.generate_content(
+    stream = await get_client().aio.models.generate_content_stream(
         model=model,
-        contents=contents, 
-        config=types.GenerateContentConfig(
-            system_instruction=system_instruction,
-            tools=[
-                types.Tool(
-                    file_search=file_search_config
-                )
-            ]
-        )
+        contents=contents,
+        config=config or _CACHED_CONFIG
     )
 
-    return response.text
+    chunks = []
+    async for chunk in stream:
+        if chunk.text:
+            chunks.append(chunk.text)
+    return "".join(chunks)
 
-def procesar_con_gemini_for_sender(sender_id: str, user_text: str) -> str:
+async def procesar_con_gemini_for_sender(sender_id: str, user_text: str) -> str:
     """
     Envuelve la lógica de construcción de 'contents' a partir del historial del remitente,
-    llama a Gemini/FileSearch y actualiza el historial en 'conversations'.
+    llama a Gemini/FileSearch y actualiza el historial (Redis o 'conversations').
     """
-    history_json = conversations.get(sender_id, [])
+    # Historial, resumen y caché de respuestas son lecturas independientes: van en paralelo
+    cache_key = _response_cache_key(user_text)
+    history_json, summary, cached = await asyncio.gather(
+        cargar_historial(sender_id),
+        cargar_resumen(sender_id),
+        obtener_respuesta_cacheada(cache_key)
+    )
+    history_json = history_json[-HISTORY_SUMMARY_TRIGGER:]
+    if summary:
+        history_json = [{'role': 'model', 'text': f"[Resumen de la conversación anterior] {summary}"}] + history_json
 
-    full_contents: List[types.Content] = []
-    for message in history_json:
-        part = types.Part(text=message['text'])
-        full_contents.append(types.Content(role=message['role'], parts=[part]))
+    # La caché solo aplica a preguntas sin contexto previo
+    if history_json:
+        cache_key = None
+    elif cached:
+        await guardar_turno(sender_id, user_text, cached)
+        return cached
 
-    # Añadimos la nueva pregunta del usuario
-    user_part = types.Part(text=user_text)
-    full_contents.append(types.Content(role="user", parts=[user_part]))
+    # Historial + la nueva pregunta del usuario
+    full_contents: List[types.Content] = history_to_contents(history_json, user_text)
 
     try:
-        respuesta = search_file_store(
+        respuesta = await search_file_store(
             contents=full_contents,
-            store_names=["fileSearchStores/" + FILE_SEARCH_STORE_ID],
-            model="gemini-2.5-flash",
-            system_instruction=SYSTEM_PROMPT_RESERVAS
+            model="gemini-2.5-flash"
         )
-        # Actualizar historial
-        new_history = history_json + [
-            {'role': 'user', 'text': user_text},
-            {'role': 'model', 'text': respuesta}
-        ]
-        conversations[sender_id] = new_history
+        # Actualizar historial (la respuesta queda ya convertida para el siguiente turno)
+        content_for("model", respuesta)
+        await guardar_turno(sender_id, user_text, respuesta)
+        if cache_key and respuesta:
+            await guardar_respuesta_cacheada(cache_key, respuesta)
         return respuesta
-    except Exception as e:
-        print("Error durante la generación con Gemini:", e)
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Error durante la generación con Gemini")
         # En caso de fallo, limpiamos la conversación para evitar loops
-        conversations.pop(sender_id, None)
+        try:
+            await borrar_historial(sender_id)
+        except Exception:
+            logger.exception("Error limpiando el historial de %s", sender_id)
         return "Lo siento, ocurrió un problema procesando tu consulta. Intenta nuevamente más tarde."
 
 # -------------------------
 # FUNCION PARA ENVIAR MENSAJES POR WHATSAPP (Cloud API)
 # -------------------------
-def enviar_mensaje_whatsapp(to_number: str, message: str) -> dict:
+async def enviar_mensaje_whatsapp(to_number: str, message: str) -> dict:
     """
     Envía un mensaje de texto simple por la API de WhatsApp Cloud.
-    Retorna la respuesta del endpoint (requests.Response.json) si es posible.
+    Retorna la respuesta del endpoint (JSON) si es posible.
+    """
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to_number,
+        "type": "text",
+        "text": {"body": message}
+    }
+    return await _post_whatsapp(payload)
+
+async def enviar_indicador_escribiendo(message_id: str) -> dict:
+    """
+    Marca el mensaje recibido como leído y muestra "escribiendo..." al usuario
+    mientras se genera la respuesta (se oculta al enviar la respuesta o a los 25 s).
+    """
+    payload = {
+        "messaging_product": "whatsapp",
+        "status": "read",
+        "message_id": message_id,
+        "typing_indicator": {"type": "text"}
+    }
+    return await _post_whatsapp(payload)
+
+def _retry_delay(resp: httpx.Response, attempt: int) -> Optional[float]:
+    """
+    Segundos a esperar antes de reintentar 'resp', o None si no debe reintentarse.
+    """
+    retry_after = resp.headers.get("Retry-After", "")
+    if resp.status_code == 429:
+        return min(float(retry_after), 10.0) if retry_after.isdigit() else 0.2 * 2 ** attempt
+    if resp.status_code == 503 and retry_after.isdigit():
+        return min(float(retry_after), 10.0)
+    return None
+
+async def _post_whatsapp(payload: dict) -> dict:
+    """
+    Envía 'payload' al endpoint /messages de la API de WhatsApp Cloud, con reintentos.
     """
     if not WHATSAPP_TOKEN or not WHATSAPP_PHONE_ID:
-        print("WHATSAPP_TOKEN o WHATSAPP_PHONE_ID no están configurados.")
+        logger.error("WHATSAPP_TOKEN o WHATSAPP_PHONE_ID no están configurados.")
         return {"error": "Configuración WhatsApp faltante en variables de entorno."}
 
     url = f"https://graph.facebook.com/v19.0/{WHATSAPP_PHONE_ID}/messages"
@@ -140,33 +544,31 @@ def enviar_mensaje_whatsapp(to_number: str, message: str) -> dict:
         "Authorization": f"Bearer {WHATSAPP_TOKEN}",
         "Content-Type": "application/json"
     }
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to_number,
-        "type": "text",
-        "text": {"body": message}
-    }
     try:
-        resp = requests.post(url, headers=headers, json=payload, timeout=10)
-        try:
-            return resp.json()
-        except Exception:
-            return {"status_code": resp.status_code, "text": resp.text}
+        for attempt in range(WHATSAPP_MAX_RETRIES + 1):
+            resp = await get_wa_session().post(url, headers=headers, json=payload)
+            delay = _retry_delay(resp, attempt)
+            if delay is not None and attempt < WHATSAPP_MAX_RETRIES:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                return resp.json()
+            except Exception:
+                return {"status_code": resp.status_code, "text": resp.text}
     except Exception as e:
-        print("Error al enviar mensaje WhatsApp:", e)
-        traceback.print_exc()
+        logger.exception("Error al enviar mensaje WhatsApp")
         return {"error": str(e)}
 
 # -------------------------
 # RUTAS API (tu /query original + clear)
 # -------------------------
 @app.route('/query', methods=['POST'])
-def handle_query():
+async def handle_query():
     """
     Endpoint para consultas manuales (por ejemplo desde un frontend).
     Mantiene la lógica de sesiones si se usa desde navegador.
     """
-    data = request.json
+    data = await request.get_json(silent=True)
     if not data or 'query' not in data:
         return jsonify({"error": "Debe enviar un JSON con la clave 'query'."}), 400
 
@@ -174,20 +576,12 @@ def handle_query():
 
     # Usamos session para usuarios que acceden vía navegador (tu código original)
     history_json = session.get('chat_history', [])
-    full_contents: List[types.Content] = []
-    for message in history_json:
-        part = types.Part(text=message['text'])
-        full_contents.append(types.Content(role=message['role'], parts=[part]))
-
-    user_part = types.Part(text=user_query)
-    full_contents.append(types.Content(role="user", parts=[user_part]))
+    full_contents: List[types.Content] = history_to_contents(history_json, user_query)
 
     try:
-        gemini_response_text = search_file_store(
+        gemini_response_text = await search_file_store(
             contents=full_contents,
-            store_names=[FILE_SEARCH_STORE_ID],
-            model="gemini-2.5-flash",
-            system_instruction=SYSTEM_PROMPT_RESERVAS
+            model="gemini-2.5-flash"
         )
         new_history = history_json + [
             {'role': 'user', 'text': user_query},
@@ -202,13 +596,12 @@ def handle_query():
         }), 200
 
     except Exception as e:
-        print(f"Error durante la generación: {e}")
-        traceback.print_exc()
+        logger.exception("Error durante la generación")
         session.pop('chat_history', None)
         return jsonify({"error": "Ocurrió un error en la API de Gemini.", "details": str(e)}), 500
 
 @app.route('/clear', methods=['POST'])
-def clear_history():
+async def clear_history():
     """
     Limpia la memoria (historial) de la sesión actual (para /query).
     """
@@ -219,7 +612,7 @@ def clear_history():
 # RUTAS DEL WEBHOOK DE WHATSAPP
 # -------------------------
 @app.route('/webhook', methods=['GET'])
-def whatsapp_verify():
+async def whatsapp_verify():
     """
     Endpoint para verificación del webhook (cuando configuras el webhook en Facebook Developer).
     Debes usar el mismo verify token que en WHATSAPP_VERIFY_TOKEN.
@@ -232,18 +625,101 @@ def whatsapp_verify():
         return challenge, 200
     return "Verification token mismatch", 403
 
+# -------------------------
+# Deduplicación de reintentos y locks por remitente
+# -------------------------
+# Meta reenvía el webhook si no recibe el ACK a tiempo: cada message_id se procesa una sola vez.
+# Con Redis se marca con 'SET dedup:{message_id} NX EX'; sin Redis, en memoria del worker.
+seen_message_ids = cachetools.TTLCache(maxsize=10_000, ttl=DEDUP_TTL_SECONDS)
+
+# Un lock por remitente (mientras tenga mensajes en curso) para no escribir su historial en paralelo
+_sender_locks = weakref.WeakValueDictionary()
+
+async def es_mensaje_nuevo(message_id: Optional[str]) -> bool:
+    """
+    Devuelve True la primera vez que se recibe 'message_id' y False en los reintentos.
+    """
+    if not message_id:
+        return True
+    if redis_client is None:
+        if message_id in seen_message_ids:
+            return False
+        seen_message_ids[message_id] = True
+        return True
+    return bool(await redis_client.set(f"dedup:{message_id}", 1, nx=True, ex=DEDUP_TTL_SECONDS))
+
+async def olvidar_mensajes(message_ids: List[str]) -> None:
+    """
+    Quita la marca de 'es_mensaje_nuevo' para que el reintento de Meta vuelva a procesarlos.
+    """
+    if not message_ids:
+        return
+    if redis_client is None:
+        for message_id in message_ids:
+            seen_message_ids.pop(message_id, None)
+        return
+    await redis_client.delete(*[f"dedup:{message_id}" for message_id in message_ids])
+
+def _sender_lock(sender: str) -> asyncio.Lock:
+    lock = _sender_locks.get(sender)
+    if lock is None:
+        lock = asyncio.Lock()
+        _sender_locks[sender] = lock
+    return lock
+
+async def procesar_y_enviar(sender: str, user_text: str, message_id: Optional[str] = None) -> None:
+    """
+    Procesa los mensajes de un remitente con Gemini/FileSearch y envía la respuesta por WhatsApp.
+    'message_id' es el último mensaje recibido; se usa para mostrar "escribiendo..." al usuario.
+    """
+    try:
+        # El usuario ve actividad de inmediato, sin esperar a que Gemini termine
+        if message_id:
+            app.add_background_task(enviar_indicador_escribiendo, message_id)
+
+        async with _sender_lock(sender):
+            # Procesar con RAG (por remitente)
+            bot_response = await procesar_con_gemini_for_sender(sender, user_text)
+
+            # Enviar respuesta por WhatsApp
+            send_result = await enviar_mensaje_whatsapp(sender, bot_response)
+        # (opcional) loguear send_result
+        logger.info("Envío WhatsApp resultado: %s", send_result)
+    except Exception:
+        logger.exception("Error procesando mensaje en segundo plano")
+
+async def _handle_messages(items: List[tuple]) -> None:
+    """
+    Procesa en paralelo los mensajes (remitente, texto, id del último mensaje) de un mismo
+    webhook, uno por remitente: la latencia total es la del remitente más lento, no la suma.
+    Se ejecuta como tarea en segundo plano, fuera del ciclo de la petición.
+    """
+    results = await asyncio.gather(
+        *[procesar_y_enviar(sender, user_text, message_id) for sender, user_text, message_id in items],
+        return_exceptions=True
+    )
+    # Un fallo inesperado en un remitente no cancela a los demás; solo se registra
+    for (sender, _, _), result in zip(items, results):
+        if isinstance(result, BaseException):
+            logger.error("Error procesando mensajes de %s: %r", sender, result)
+
 @app.route('/webhook', methods=['POST'])
-def whatsapp_webhook():
+async def whatsapp_webhook():
     """
     Endpoint que recibe eventos de WhatsApp Cloud API.
-    Extrae el número del remitente y el texto, procesa con Gemini/FileSearch y responde.
+    Extrae el número del remitente y el texto y encola su procesamiento con Gemini/FileSearch;
+    responde a Meta inmediatamente para evitar reintentos.
     """
-    payload = request.get_json(silent=True)
+    payload = await request.get_json(silent=True)
     if not payload:
         return "no payload", 400
 
     # Manejo basado en la estructura típica de WhatsApp Cloud API
+    marked_ids = []
     try:
+        # 1) Leer todo el payload antes de marcar nada: si algo falla aquí, Meta reintenta
+        #    y ningún mensaje se ha dado aún por recibido.
+        parsed = []  # (sender, mtype, user_text, message_id)
         entries = payload.get("entry", [])
         for entry in entries:
             changes = entry.get("changes", [])
@@ -255,33 +731,52 @@ def whatsapp_webhook():
                     sender = message.get("from")  # número de WhatsApp (ej "519XXXXXXXX")
                     if not sender:
                         continue
-
                     mtype = message.get("type")
-                    if mtype == "text":
-                        user_text = message["text"].get("body", "")
-                    else:
-                        # Puedes añadir soporte para contactos, ubicaciones, etc.
-                        user_text = f"[Tipo de mensaje {mtype} no soportado por ahora]"
-
-                    # Procesar con RAG (por remitente)
-                    bot_response = procesar_con_gemini_for_sender(sender, user_text)
-
-                    # Enviar respuesta por WhatsApp
-                    send_result = enviar_mensaje_whatsapp(sender, bot_response)
-                    # (opcional) loguear send_result
-                    print("Envío WhatsApp resultado:", send_result)
+                    user_text = (message.get("text") or {}).get("body", "") if mtype == "text" else ""
+                    parsed.append((sender, mtype, user_text, message.get("id")))
+
+        # 2) Descartar reintentos de Meta de mensajes ya recibidos y agrupar por remitente:
+        #    varios mensajes seguidos de un mismo usuario se responden con una sola llamada a Gemini.
+        by_sender = defaultdict(list)
+        last_message_id = {}
+        unsupported_senders = []
+        for sender, mtype, user_text, message_id in parsed:
+            if not await es_mensaje_nuevo(message_id):
+                continue
+            if message_id:
+                marked_ids.append(message_id)
+
+            if mtype == "text" and not user_text.strip():
+                # Texto sin cuerpo: queda marcado como recibido pero no llega a Gemini
+                continue
+
+            if mtype != "text":
+                # Puedes añadir soporte para contactos, ubicaciones, etc.
+                # Respuesta fija: sin llamada a Gemini ni cambios en el historial
+                if sender not in unsupported_senders:
+                    unsupported_senders.append(sender)
+                continue
+
+            by_sender[sender].append(user_text)
+            last_message_id[sender] = message_id
+
+        # 3) Procesar en segundo plano para responder a Meta de inmediato
+        for sender in unsupported_senders:
+            app.add_background_task(enviar_mensaje_whatsapp, sender, MENSAJE_NO_SOPORTADO)
+        items = [
+            (sender, "\n".join(texts), last_message_id.get(sender))
+            for sender, texts in by_sender.items()
+        ]
+        if items:
+            app.add_background_task(_handle_messages, items)
 
         return "EVENT_RECEIVED", 200
 
-    except Exception as e:
-        print("Error procesando webhook:", e)
-        traceback.print_exc()
+    except Exception:
+        logger.exception("Error procesando webhook")
+        # Meta reintentará el webhook: los mensajes ya marcados deben volver a procesarse
+        try:
+            await olvidar_mensajes(marked_ids)
+        except Exception:
+            logger.exception("Error quitando las marcas de deduplicación")
         return "error", 500
-
-# -------------------------
-# RUN (Railway / Heroku compatible)
-# -------------------------
-if __name__ == '__main__':
-    port = int(os.environ.get("PORT", 5000))
-    print(f"🚀 API iniciada en 0.0.0.0:{port}")
-    app.run(host="0.0.0.0", port=port)
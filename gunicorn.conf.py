@@ -0,0 +1,29 @@
+# gunicorn.conf.py
+# Configuración de gunicorn (Railway / Heroku compatible).
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Sin REDIS_URL el historial, la deduplicación y las cachés viven en memoria de cada worker:
+# con varios workers un mismo chat repartiría sus mensajes entre historiales distintos.
+# Por eso el valor por defecto es 2 * CPU + 1 workers con Redis y 1 sin él; se puede fijar
+# con WEB_CONCURRENCY.
+REDIS_URL = os.environ.get("REDIS_URL", "")
+default_workers = multiprocessing.cpu_count() * 2 + 1 if REDIS_URL else 1
+workers = int(os.environ.get("WEB_CONCURRENCY", default_workers))
+
+# Workers ASGI (uvicorn) para la app Quart: cada worker atiende muchos webhooks a la vez
+# mientras otros esperan la respuesta de Gemini o de WhatsApp.
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Las llamadas a Gemini pueden tardar varios segundos.
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+
+def on_starting(server):
+    if workers > 1 and not REDIS_URL:
+        server.log.warning(
+            "WEB_CONCURRENCY=%s sin REDIS_URL: cada worker tendrá su propio historial y su propia "
+            "deduplicación de mensajes. Configura REDIS_URL o usa un solo worker.", workers
+        )